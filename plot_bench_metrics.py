@@ -3,140 +3,342 @@
 Visualizer for zkbench summary.dat file
 Plots: avg latency, max latency, p99 latency, throughput over time, separate by bench_type(READ/WRITE)
 """
+import os
+import re
 import sys
 import csv
-from datetime import datetime
-import matplotlib.pyplot as plt
-from collections import defaultdict
+import tempfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python plot_bench_metrics.py <summary.dat>")
-        sys.exit(1)
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+BENCH_TYPES = ['READ', 'WRITE', 'MIXED']
+
+# Approximate width of one subplot in pixels (14in @ 150dpi, two columns)
+PLOT_WIDTH_PX = 14 * 150 // 2
+
+# Denser markers just merge into the line at 150dpi
+MAX_MARKERS = 200
+
+
+# Go trims trailing zeros from the fraction (and may print more than six
+# digits), so the fraction is captured separately and padded/truncated
+TIMESTAMP_RE = re.compile(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})')
+
+
+def parse_timestamp(ts_str):
+    # Parse timestamp (default 8-digit microseconds from Go)
+    match = TIMESTAMP_RE.fullmatch(ts_str)
+    if match is None:
+        raise ValueError(f"Invalid group_start_time: {ts_str!r}")
+    base, frac, tz = match.groups()
+    return datetime.fromisoformat(f"{base}.{(frac or '')[:6]:0<6}{'+00:00' if tz == 'Z' else tz}")
+
+
+def m4_downsample(x, y, n_pixels):
+    """Keep the first, last, min and max sample of every pixel column (M4)"""
+    if len(x) <= 4 * n_pixels:
+        return x, y
+    # x is sorted, so each pixel column is a contiguous run of samples
+    bins = ((x - x[0]) / (x[-1] - x[0]) * (n_pixels - 1)).astype(np.int64)
+    is_start = np.empty(len(x), dtype=bool)
+    is_start[0] = True
+    np.not_equal(bins[1:], bins[:-1], out=is_start[1:])
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(x)) - 1
+    # Sorting by (column, y) puts each column's min at its start, max at its end
+    order = np.lexsort((y, np.cumsum(is_start)))
+    keep = np.unique(np.concatenate((starts, ends, order[starts], order[ends])))
+    return x[keep], y[keep]
+
+
+def plot_series(ax, x, y, **kwargs):
+    """Plot a time series downsampled to the subplot width, with thinned markers"""
+    x, y = m4_downsample(x, y, PLOT_WIDTH_PX)
+    ax.plot(x, y, marker='o', markersize=4, markevery=max(1, len(x) // MAX_MARKERS), **kwargs)
+
+
+def load_summary_arrow(csv_file):
+    """Parse and filter summary.dat inside Arrow's C++ kernels"""
+    # Stat before scanning: rows appended while we parse must invalidate the
+    # sidecar written below
+    csv_stat = os.stat(csv_file)
+    # Arrow cannot infer a schema from an empty file
+    if csv_stat.st_size == 0:
+        return {}
+    schema = pa.schema([
+        ('bench_type', pa.string()),
+        ('group_start_time', pa.timestamp('ns', tz='UTC')),
+        ('average_latency', pa.float64()),
+        ('max_latency', pa.float64()),
+        ('99th_latency', pa.float64()),
+        ('throughput', pa.float64()),
+    ])
+    columns = schema.names
+    bench_filter = ds.field('bench_type').isin(BENCH_TYPES)
     
-    csv_file = sys.argv[1]
+    # Re-plots read the columnar sidecar written by an earlier run, as long
+    # as it was built from exactly this summary.dat (same size and mtime;
+    # comparing the sidecar's own mtime misses appends made during a scan)
+    parquet_file = csv_file + '.parquet'
+    source_metadata = {
+        b'summary_size': str(csv_stat.st_size).encode(),
+        b'summary_mtime_ns': str(csv_stat.st_mtime_ns).encode(),
+    }
+    if os.path.exists(parquet_file):
+        try:
+            metadata = pq.read_schema(parquet_file).metadata or {}
+            if all(metadata.get(key) == value for key, value in source_metadata.items()):
+                tbl = ds.dataset(parquet_file, format='parquet').to_table(columns=columns, filter=bench_filter)
+                return split_by_type(tbl)
+        except (OSError, pa.ArrowInvalid) as e:
+            print(f"Warning: ignoring unreadable {parquet_file}: {e}", file=sys.stderr)
     
-    # Aggregate by bench_type and timestamp
-    data_by_type = defaultdict(lambda: defaultdict(lambda: {
-        'avg_lat': [], 'max_lat': [], 'p99_lat': [], 'throughput': []
-    }))
+    # Every Run appends a fresh header line to summary.dat, so read the
+    # columns as strings and only cast once the filter has dropped those rows
+    convert_options = pacsv.ConvertOptions(
+        column_types={name: pa.string() for name in columns})
+    # Memory-map the file so the parser reads straight from the page cache,
+    # and push the bench_type filter into the scan so rejected rows are
+    # dropped batch by batch instead of after the whole table is built
+    dataset = ds.dataset(os.path.abspath(csv_file),
+                         format=ds.CsvFileFormat(convert_options=convert_options),
+                         filesystem=pafs.LocalFileSystem(use_mmap=True))
+    tbl = dataset.to_table(columns=columns, filter=bench_filter).cast(schema)
+    
+    # The sidecar is only a cache; plotting must not fail when the directory
+    # is read-only. Each run writes its own temp file and renames it into
+    # place, so neither a reader nor a concurrent writer sees a partial one.
+    tmp_file = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(parquet_file)),
+                                         prefix=os.path.basename(parquet_file) + '.',
+                                         suffix='.tmp', delete=False) as f:
+            tmp_file = f.name
+            pq.write_table(tbl.replace_schema_metadata(source_metadata), f)
+        # NamedTemporaryFile creates 0600; give the cache summary.dat's mode so
+        # other users re-plotting a shared results directory can read it
+        os.chmod(tmp_file, csv_stat.st_mode & 0o666)
+        os.replace(tmp_file, parquet_file)
+    except OSError as e:
+        print(f"Warning: could not write {parquet_file}: {e}", file=sys.stderr)
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return split_by_type(tbl)
+
+
+def split_by_type(tbl):
+    """Split an Arrow table into per-bench_type numpy columns"""
+    rows_by_type = {}
+    for btype in pc.unique(tbl['bench_type']).to_pylist():
+        rows = tbl.filter(pc.equal(tbl['bench_type'], btype))
+        rows_by_type[btype] = (
+            rows['group_start_time'].cast(pa.int64()).to_numpy(),
+            rows['average_latency'].to_numpy(),
+            rows['max_latency'].to_numpy(),
+            rows['99th_latency'].to_numpy(),
+            rows['throughput'].to_numpy(),
+        )
+    return rows_by_type
+
+
+def load_summary_csv(csv_file):
+    """Pure-Python fallback for hosts without pyarrow"""
+    btypes, ts_strs, avg_lats, max_lats, p99_lats, throughputs = [], [], [], [], [], []
     
     with open(csv_file, 'r') as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        # Resolve column positions once instead of building a dict per row
+        header = next(reader, None)
+        if header is None:
+            return {}
+        b_i, t_i, a_i, m_i, p_i, th_i = [header.index(name) for name in (
+            'bench_type', 'group_start_time', 'average_latency',
+            'max_latency', '99th_latency', 'throughput')]
         for row in reader:
-            btype = row['bench_type']
+            btype = row[b_i]
             
             # Only process READ, WRITE, and MIXED
-            if btype not in ['READ', 'WRITE', 'MIXED']:
+            if btype not in BENCH_TYPES:
                 continue
             
-            # Parse timestamp (default 8-digit microseconds from Go)
-            ts_str = row['group_start_time'].replace('Z', '+00:00')
-            if '.' in ts_str and '+' in ts_str:
-                base, rest = ts_str.split('.')
-                microsec, tz = rest.split('+')
-                ts_str = f"{base}.{microsec[:6].ljust(6, '0')}+{tz}"
-            start_time = datetime.fromisoformat(ts_str)
-            
-            # Parse latencies (nanoseconds -> milliseconds)
-            avg_lat = float(row['average_latency']) / 1e6
-            max_lat = float(row['max_latency']) / 1e6
-            p99_lat = float(row['99th_latency']) / 1e6
-            throughput = float(row['throughput'])
-            
-            # Group by bench_type and timestamp
-            data_by_type[btype][start_time]['avg_lat'].append(avg_lat)
-            data_by_type[btype][start_time]['max_lat'].append(max_lat)
-            data_by_type[btype][start_time]['p99_lat'].append(p99_lat)
-            data_by_type[btype][start_time]['throughput'].append(throughput)
+            # Keep the raw strings; numpy converts whole columns below
+            btypes.append(btype)
+            ts_strs.append(row[t_i])
+            avg_lats.append(row[a_i])
+            max_lats.append(row[m_i])
+            p99_lats.append(row[p_i])
+            throughputs.append(row[th_i])
+    
+    if not btypes:
+        return {}
+    
+    # All clients of a group share the same timestamp string, so parse each
+    # distinct timestamp only once
+    uniq_ts, ts_idx = np.unique(ts_strs, return_inverse=True)
+    # Convert to naive UTC (as the Arrow path does) rather than dropping offsets
+    parsed = [parse_timestamp(ts_str).astimezone(timezone.utc).replace(tzinfo=None) for ts_str in uniq_ts]
+    ts_ns = np.array(parsed, dtype='datetime64[ns]').view(np.int64)[ts_idx]
+    btypes = np.array(btypes)
+    columns = [np.asarray(column, dtype=np.float64)
+               for column in (avg_lats, max_lats, p99_lats, throughputs)]
+    
+    rows_by_type = {}
+    for btype in np.unique(btypes):
+        mask = btypes == btype
+        rows_by_type[str(btype)] = (ts_ns[mask], *(column[mask] for column in columns))
+    return rows_by_type
+
+
+def aggregate(ts_ns, avg_lat, max_lat, p99_lat, throughput, bucket_ns=0):
+    """Average latencies and sum throughput across all clients at each timestamp"""
+    # Optionally quantize to the bucket size. Every row in a bucket counts
+    # towards it, so runs starting within one bucket have their throughput
+    # summed; the Go writer stamps a whole group with one time, so exact
+    # timestamps (bucket_ns=0) are the default
+    if bucket_ns > 0:
+        ts_ns = ts_ns // bucket_ns * bucket_ns
+    # Integer keys: np.unique sorts them and maps every row to its group
+    timestamps, ts_idx = np.unique(ts_ns, return_inverse=True)
+    counts = np.bincount(ts_idx)
+    return (
+        timestamps.view('datetime64[ns]'),
+        # nanoseconds -> milliseconds
+        np.bincount(ts_idx, weights=avg_lat) / counts / 1e6,
+        np.bincount(ts_idx, weights=max_lat) / counts / 1e6,
+        np.bincount(ts_idx, weights=p99_lat) / counts / 1e6,
+        np.bincount(ts_idx, weights=throughput),
+    )
+
+
+def render(btype, time_seconds, avg_lats, max_lats, p99_lats, throughputs, output):
+    """Draw the 2x2 metrics figure for one bench_type and save it to output"""
+    # Create 2x2 subplot (object-oriented API on an Agg canvas: PNG output
+    # only, no pyplot state)
+    fig = Figure(figsize=(14, 10))
+    FigureCanvasAgg(fig)
+    # All four panels share the time axis, so only the bottom row needs
+    # tick labels and an x label
+    axes = fig.subplots(2, 2, sharex=True)
+    fig.suptitle(f'ZKBench Metrics - {btype} Operations', fontsize=14, fontweight='bold')
     
-    if not data_by_type:
+    # Plot 1: Average Latency over time
+    ax1 = axes[0, 0]
+    plot_series(ax1, time_seconds, avg_lats, color='blue', linewidth=2, label='Avg Latency')
+    ax1.set_title('Average Latency (Mean across clients)')
+    ax1.set_ylabel('Latency (ms)')
+    ax1.grid(True, alpha=0.3)
+    ax1.legend()
+    
+    # Plot 2: Max Latency over time
+    ax2 = axes[0, 1]
+    plot_series(ax2, time_seconds, max_lats, color='red', linewidth=2, label='Max Latency')
+    ax2.set_title('Max Latency (Mean across clients)')
+    ax2.set_ylabel('Latency (ms)')
+    ax2.grid(True, alpha=0.3)
+    ax2.legend()
+    
+    # Plot 3: P99 Latency over time
+    ax3 = axes[1, 0]
+    plot_series(ax3, time_seconds, p99_lats, color='orange', linewidth=2, label='P99 Latency')
+    ax3.set_title('99th Percentile Latency (Mean across clients)')
+    ax3.set_xlabel('Time (seconds)')
+    ax3.set_ylabel('Latency (ms)')
+    ax3.grid(True, alpha=0.3)
+    ax3.legend()
+    
+    # Plot 4: Throughput (sum across all clients at each timestamp)
+    ax4 = axes[1, 1]
+    plot_series(ax4, time_seconds, throughputs, color='green', linewidth=2, label='Throughput (sum)')
+    ax4.set_title('Throughput (Sum across all clients)')
+    ax4.set_xlabel('Time (seconds)')
+    ax4.set_ylabel('Operations/second')
+    ax4.grid(True, alpha=0.3)
+    ax4.legend()
+    
+    fig.tight_layout()
+    
+    # Save figure
+    fig.savefig(output, dpi=150, bbox_inches='tight')
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plot zkbench summary.dat metrics')
+    parser.add_argument('csv_file', metavar='summary.dat')
+    parser.add_argument('--engine', choices=['pyarrow', 'python'],
+                        default='pyarrow' if pa is not None else 'python',
+                        help='CSV reader (default: pyarrow if installed)')
+    parser.add_argument('--bucket-ms', type=int, default=0,
+                        help='group timestamps into buckets of this many ms; '
+                             'throughput is summed across every row in a bucket, '
+                             'so runs starting within one bucket are added together '
+                             '(default: 0, exact timestamps)')
+    args = parser.parse_args()
+    
+    if args.engine == 'pyarrow' and pa is None:
+        parser.error('--engine pyarrow requires the pyarrow package')
+    if args.bucket_ms < 0:
+        parser.error('--bucket-ms must not be negative')
+    
+    csv_file = args.csv_file
+    
+    if args.engine == 'pyarrow':
+        rows_by_type = load_summary_arrow(csv_file)
+    else:
+        rows_by_type = load_summary_csv(csv_file)
+    
+    if not rows_by_type:
         print("No READ/WRITE test data found")
         sys.exit(0)
     
-    # Process each bench_type separately
-    for btype in sorted(data_by_type.keys()):
-        data_by_timestamp = data_by_type[btype]
-        
-        # Sort timestamps and aggregate metrics
-        sorted_timestamps = sorted(data_by_timestamp.keys())
-        
-        # For each timestamp: average latencies, sum throughput
-        avg_lats = []
-        max_lats = []
-        p99_lats = []
-        throughputs = []
-        timestamps = []
-        
-        for ts in sorted_timestamps:
-            data = data_by_timestamp[ts]
-            
-            # Average latencies across all clients at this timestamp
-            avg_lats.append(sum(data['avg_lat']) / len(data['avg_lat']))
-            max_lats.append(sum(data['max_lat']) / len(data['max_lat']))
-            p99_lats.append(sum(data['p99_lat']) / len(data['p99_lat']))
-            
-            # Sum throughput across all clients at this timestamp
-            throughputs.append(sum(data['throughput']))
-            timestamps.append(ts)
-
-        print("a", len(throughputs), throughputs)
+    # Process each bench_type separately; aggregate here so the workers only
+    # receive the per-timestamp series, not the raw rows
+    jobs = []
+    for btype in sorted(rows_by_type.keys()):
+        timestamps, avg_lats, max_lats, p99_lats, throughputs = aggregate(*rows_by_type[btype], bucket_ns=args.bucket_ms * 1_000_000)
 
         # Convert timestamps to relative seconds from start
-        if timestamps:
-            start_ts = timestamps[0]
-            time_seconds = [(ts - start_ts).total_seconds() for ts in timestamps]
-        else:
-            continue
-        
-        # Create 2x2 subplot
-        fig, axes = plt.subplots(2, 2, figsize=(14, 10))
-        fig.suptitle(f'ZKBench Metrics - {btype} Operations', fontsize=14, fontweight='bold')
-        
-        # Plot 1: Average Latency over time
-        ax1 = axes[0, 0]
-        ax1.plot(time_seconds, avg_lats, marker='o', markersize=4, color='blue', linewidth=2, label='Avg Latency')
-        ax1.set_title('Average Latency (Mean across clients)')
-        ax1.set_xlabel('Time (seconds)')
-        ax1.set_ylabel('Latency (ms)')
-        ax1.grid(True, alpha=0.3)
-        ax1.legend()
-        
-        # Plot 2: Max Latency over time
-        ax2 = axes[0, 1]
-        ax2.plot(time_seconds, max_lats, marker='o', markersize=4, color='red', linewidth=2, label='Max Latency')
-        ax2.set_title('Max Latency (Mean across clients)')
-        ax2.set_xlabel('Time (seconds)')
-        ax2.set_ylabel('Latency (ms)')
-        ax2.grid(True, alpha=0.3)
-        ax2.legend()
+        time_seconds = (timestamps - timestamps[0]) / np.timedelta64(1, 's')
         
-        # Plot 3: P99 Latency over time
-        ax3 = axes[1, 0]
-        ax3.plot(time_seconds, p99_lats, marker='o', markersize=4, color='orange', linewidth=2, label='P99 Latency')
-        ax3.set_title('99th Percentile Latency (Mean across clients)')
-        ax3.set_xlabel('Time (seconds)')
-        ax3.set_ylabel('Latency (ms)')
-        ax3.grid(True, alpha=0.3)
-        ax3.legend()
-        
-        # Plot 4: Throughput (sum across all clients at each timestamp)
-        ax4 = axes[1, 1]
-        ax4.plot(time_seconds, throughputs, marker='o', markersize=4, color='green', linewidth=2, label='Throughput (sum)')
-        ax4.set_title('Throughput (Sum across all clients)')
-        ax4.set_xlabel('Time (seconds)')
-        ax4.set_ylabel('Operations/second')
-        ax4.grid(True, alpha=0.3)
-        ax4.legend()
-        
-        plt.tight_layout()
-        
-        # Save figure
         output = csv_file.replace('.dat', f'_{btype}_metrics.png')
-        plt.savefig(output, dpi=150, bbox_inches='tight')
+        jobs.append((btype, time_seconds, avg_lats, max_lats, p99_lats, throughputs, output))
+    
+    # Every bench_type is an independent figure, so render them in parallel.
+    # Count only the CPUs this process may run on (cgroup/affinity limits).
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    workers = min(len(jobs), cpus)
+    if workers > 1:
+        # The Arrow scan leaves its thread pool running, and forking a
+        # multi-threaded process can deadlock; start clean workers instead
+        # (render() only needs picklable numpy arrays)
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context(start_method)) as pool:
+            futures = [pool.submit(render, *job) for job in jobs]
+            outputs = [future.result() for future in futures]
+    else:
+        outputs = [render(*job) for job in jobs]
+    
+    for output in outputs:
         print(f"Saved: {output}")
-        
-        plt.close()
 
 if __name__ == '__main__':
     main()